@@ -19,19 +19,14 @@ You should have received a copy of the GNU General Public License
 along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import unicode_literals, print_function
+import contextlib
+import difflib
+import hashlib
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 from ansible.module_utils.basic import AnsibleModule
 
 
-# FIX for Ansible 2.8 moving this function and making it private
-# greatly simplified for napalm-ansible's use
-def return_values(obj):
-    """Return native stringified values from datastructures.
-
-    For use with removing sensitive values pre-jsonification."""
-    yield str(obj)
-
-
 DOCUMENTATION = """
 ---
 module: napalm_install_config
@@ -114,7 +109,8 @@ options:
     archive_file:
         description:
             - File to store backup of running-configuration from device. Configuration will not be
-              retrieved if not set.
+              retrieved if not set. When candidate_file is also set, the backup is written after
+              the candidate is loaded, from the same request as the candidate.
         default: None
         required: False
     candidate_file:
@@ -122,6 +118,33 @@ options:
             - Store a backup of candidate config from device prior to a commit.
         default: None
         required: False
+    commit_comment:
+        description:
+            - Comment to attach to the commit, on platforms that support it.
+        default: None
+        required: False
+    local_diff:
+        description:
+            - Compute the diff locally between the running and candidate configs retrieved from
+              the device instead of having the device generate it. When neither diff_file nor
+              diff mode are used only whether the configs differ is reported. Line endings and
+              trailing whitespace are ignored.
+            - The configs are compared as text, lines the device adds to the running config
+              itself (e.g. "Building configuration..." headers or timestamps) are reported as
+              changes, and so is every merge on drivers whose candidate is only the loaded
+              snippet rather than the full config. Only use it with drivers whose candidate
+              config is the complete resulting config.
+        choices: [true,false]
+        default: False
+        required: False
+    skip_if_equal:
+        description:
+            - When replacing the configuration and the running configuration has been retrieved
+              (see archive_file), skip loading and diffing the candidate if it is identical to
+              the running configuration. Ignored for merge operations.
+        choices: [true,false]
+        default: False
+        required: False
 """
 
 EXAMPLES = """
@@ -158,27 +181,228 @@ changed:
     type: bool
     sample: True
 diff:
-    description: diff of the change
+    description:
+        - diff of the change, truncated to 300 lines (diff_file gets the full diff)
+        - when diff_file is set and diff mode is not used, only a summary of the diff with
+          prepared left empty
     returned: always
     type: dict
     sample: {
         'prepared': "[edit system]\n-  host-name lab-testing;\n+  host-name lab;",
     }
+msg:
+    description:
+        - diff of the change, truncated to 300 lines like diff
+        - kept for backwards compatibility even when diff only holds a summary, so up to
+          300 lines (64 KiB) of diff are still returned when diff_file is set
+    returned: always
+    type: str
+    sample: "[edit system]\n-  host-name lab-testing;\n+  host-name lab;"
 """
 
-napalm_found = False
-try:
-    from napalm import get_network_driver
-    from napalm.base import ModuleImportError
+# driver classes by dev_os, for persistent interpreters running main() several times
+_driver_cache = {}
+
+# larger diffs are slow for Ansible to serialize, they are only saved in full to diff_file
+MAX_DIFF_LINES = 300
+MAX_DIFF_SIZE = 65536
+
+
+def truncate_diff(diff, diff_file=None):
+    """Cap the diff returned to Ansible to MAX_DIFF_LINES lines and MAX_DIFF_SIZE characters."""
+    if not diff:
+        return diff
+    lines = diff.splitlines()
+    if len(diff) <= MAX_DIFF_SIZE and len(lines) <= MAX_DIFF_LINES:
+        return diff
+    short_diff = "\n".join(lines[:MAX_DIFF_LINES])[:MAX_DIFF_SIZE]
+    if diff_file is not None:
+        return short_diff + "\n... [truncated, full diff in " + diff_file + "]"
+    return short_diff + "\n... [truncated]"
+
+
+def summarize_diff(diff, diff_file):
+    """Return a fixed-size summary of a diff saved to diff_file."""
+    lines_added = lines_removed = 0
+    for line in diff.splitlines():
+        if line.startswith("+") and not line.startswith("+++"):
+            lines_added += 1
+        elif line.startswith("-") and not line.startswith("---"):
+            lines_removed += 1
+    return {
+        "prepared": "",
+        "diff_file": diff_file,
+        "lines_added": lines_added,
+        "lines_removed": lines_removed,
+        "lines_changed": lines_added + lines_removed,
+    }
+
 
-    napalm_found = True
-except ImportError:
-    pass
+def expand_path(path):
+    """Expand environment variables and ``~`` in path, if it contains any."""
+    if not path or ("$" not in path and "~" not in path):
+        return path
+    return os.path.expanduser(os.path.expandvars(path))
 
 
 def save_to_file(content, filename):
-    with open(filename, "w") as f:
-        f.write(content)
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    with open(filename, "wb", buffering=2 ** 20) as f:
+        f.write(data)
+
+
+def file_digest(filename):
+    """Return the MD5 digest of filename, reading it in chunks rather than all at once."""
+    digest = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def save_to_file_if_changed(content, filename):
+    """Like save_to_file but leave filename untouched if it already holds content."""
+    data = content.encode("utf-8")
+    try:
+        if os.path.getsize(filename) == len(data):
+            if file_digest(filename) == hashlib.md5(data).digest():
+                return
+    except FileNotFoundError:
+        pass
+    save_to_file(data, filename)
+
+
+def normalize_config(content):
+    """Return content with LF line endings and no trailing whitespace on each line."""
+    lines = content.replace("\r\n", "\n").rstrip("\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines) + "\n"
+
+
+def config_digest(content):
+    """Return the MD5 digest of a configuration, ignoring whitespace differences."""
+    return hashlib.md5(normalize_config(content).encode("utf-8")).digest()
+
+
+def get_config(device, configs, which, retrieve=None):
+    """Return the ``which`` config, only asking the device for it when not in ``configs``."""
+    if which not in configs:
+        retrieve = retrieve or which
+        retrieved = device.get_config(retrieve=retrieve)
+        # the configs that were not asked for are returned empty
+        if retrieve == "all":
+            configs.update(retrieved)
+        else:
+            configs[retrieve] = retrieved[retrieve]
+    return configs[which]
+
+
+def save_config(device, configs, which, filename, retrieve=None):
+    """Save the ``which`` config to filename, see get_config."""
+    save_to_file_if_changed(get_config(device, configs, which, retrieve), filename)
+
+
+def compare_configs(device, configs, local_diff, need_diff):
+    """Return whether the candidate changes the running config and the diff between them.
+
+    With local_diff the diff is computed here from the normalized configs retrieved from the
+    device, or they are only compared when need_diff is False and the returned diff is None.
+    """
+    if not local_diff:
+        diff = device.compare_config()
+        return len(diff) > 0, diff
+
+    retrieve = "candidate" if "running" in configs else "all"
+    # both modes compare the same normalized forms so that asking for the diff can't
+    # change the outcome
+    candidate_config = normalize_config(
+        get_config(device, configs, "candidate", retrieve)
+    )
+    running_config = normalize_config(get_config(device, configs, "running"))
+    if not need_diff:
+        return running_config != candidate_config, None
+    diff = "\n".join(
+        difflib.unified_diff(
+            running_config.splitlines(),
+            candidate_config.splitlines(),
+            fromfile="running",
+            tofile="candidate",
+            lineterm="",
+        )
+    )
+    return len(diff) > 0, diff
+
+
+def read_config_file(filename):
+    """Read filename in one go instead of letting the driver stream it."""
+    with open(filename, "rb", buffering=2 ** 20) as f:
+        return f.read().decode("utf-8")
+
+
+def open_device(network_driver, **kwargs):
+    """Instantiate network_driver with kwargs and open the connection to the device."""
+    device = network_driver(**kwargs)
+    device.open()
+    return device
+
+
+def run_step(module, label, fn, *args, **kwargs):
+    """Return the result of calling fn, failing the module with label if it raises."""
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        module.fail_json(msg=label + ": " + str(e))
+
+
+def load_candidate(device, config, replace_config):
+    """Load config on the device, replacing or merging with the running config."""
+    if replace_config:
+        device.load_replace_candidate(config=config)
+    else:
+        device.load_merge_candidate(config=config)
+
+
+def archive_running_config(module, device, configs, filename):
+    """Start saving the running config to filename and return a function completing it.
+
+    The running config is retrieved in a separate thread while the caller carries on with
+    local work, the returned function waits for it and writes filename. It has to be called
+    before the device is used again as drivers can't serve concurrent requests.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(get_config, device, configs, "running")
+    # the submitted call still runs to completion, no more work is sent to executor
+    executor.shutdown(wait=False)
+
+    def finish():
+        running_config = run_step(
+            module, "cannot retrieve running config", future.result
+        )
+        run_step(
+            module,
+            "cannot retrieve running config",
+            save_to_file_if_changed,
+            running_config,
+            filename,
+        )
+
+    return finish
+
+
+@contextlib.contextmanager
+def closing_device(module, device):
+    """Close the connection to the device when leaving the block, even on failure."""
+    try:
+        yield device
+    except BaseException:
+        try:
+            device.close()
+        except Exception:
+            pass
+        raise
+    try:
+        device.close()
+    except Exception as e:
+        module.fail_json(msg="cannot close device connection: " + str(e))
 
 
 def main():
@@ -199,142 +423,207 @@ def main():
             get_diffs=dict(type="bool", required=False, default=True),
             archive_file=dict(type="str", required=False, default=None),
             candidate_file=dict(type="str", required=False, default=None),
+            commit_comment=dict(type="str", required=False, default=None),
+            local_diff=dict(type="bool", required=False, default=False),
+            skip_if_equal=dict(type="bool", required=False, default=False),
         ),
         supports_check_mode=True,
     )
 
-    if not napalm_found:
-        module.fail_json(msg="the python module napalm is required")
-
     provider = module.params["provider"] or {}
 
     no_log = ["password", "secret"]
-    for param in no_log:
-        if provider.get(param):
-            module.no_log_values.update(return_values(provider[param]))
-        if provider.get("optional_args") and provider["optional_args"].get(param):
-            module.no_log_values.update(
-                return_values(provider["optional_args"].get(param))
-            )
-        if module.params.get("optional_args") and module.params["optional_args"].get(
-            param
-        ):
-            module.no_log_values.update(
-                return_values(module.params["optional_args"].get(param))
-            )
+    secret_sources = [
+        provider,
+        provider.get("optional_args") or {},
+        module.params.get("optional_args") or {},
+    ]
+    secrets = tuple(source.get(param) for source in secret_sources for param in no_log)
+    for secret in secrets:
+        if secret:
+            module.no_log_values.add(str(secret))
 
     # allow host or hostname
     provider["hostname"] = provider.get("hostname", None) or provider.get("host", None)
-    # allow local params to override provider
+    # allow local params to override provider, only unset ones are taken from it
     for param, pvalue in provider.items():
-        if module.params.get(param) is not False:
-            module.params[param] = module.params.get(param) or pvalue
+        if module.params.get(param) is None:
+            module.params[param] = pvalue
 
     hostname = module.params["hostname"]
     username = module.params["username"]
     dev_os = module.params["dev_os"]
     password = module.params["password"]
     timeout = module.params["timeout"]
-    config_file = module.params["config_file"]
+    config_file = expand_path(module.params["config_file"])
     config = module.params["config"]
     commit_changes = module.params["commit_changes"]
     replace_config = module.params["replace_config"]
-    diff_file = module.params["diff_file"]
+    diff_file = expand_path(module.params["diff_file"])
     get_diffs = module.params["get_diffs"]
-    archive_file = module.params["archive_file"]
-    candidate_file = module.params["candidate_file"]
-    message = module.params["commit_comment"]
-    if config_file:
-        config_file = os.path.expanduser(os.path.expandvars(config_file))
-    if diff_file:
-        diff_file = os.path.expanduser(os.path.expandvars(diff_file))
-    if archive_file:
-        archive_file = os.path.expanduser(os.path.expandvars(archive_file))
-    if candidate_file:
-        candidate_file = os.path.expanduser(os.path.expandvars(candidate_file))
+    archive_file = expand_path(module.params["archive_file"])
+    candidate_file = expand_path(module.params["candidate_file"])
+    commit_comment = module.params["commit_comment"]
+    local_diff = module.params["local_diff"]
+    skip_if_equal = module.params["skip_if_equal"]
 
     argument_check = {"hostname": hostname, "username": username, "dev_os": dev_os}
-    for key, val in argument_check.items():
-        if val is None:
-            module.fail_json(msg=str(key) + " is required")
+    missing = [key for key, val in argument_check.items() if val is None]
+    if missing:
+        module.fail_json(msg="missing required args: " + ", ".join(missing))
 
     if module.params["optional_args"] is None:
         optional_args = {}
     else:
         optional_args = module.params["optional_args"]
 
+    if not config and not config_file:
+        module.fail_json(msg="You have to specify either config or config_file")
+    if not config:
+        config = run_step(module, "cannot load config", read_config_file, config_file)
+
+    # napalm is only imported once the arguments are validated as it is slow to import
+    try:
+        from napalm import get_network_driver
+        from napalm.base import ModuleImportError
+    except ImportError:
+        module.fail_json(msg="the python module napalm is required")
+
     try:
-        network_driver = get_network_driver(dev_os)
+        network_driver = _driver_cache.get(dev_os)
+        if network_driver is None:
+            network_driver = _driver_cache[dev_os] = get_network_driver(dev_os)
     except ModuleImportError as e:
         module.fail_json(msg="Failed to import napalm driver: " + str(e))
 
-    try:
-        device = network_driver(
-            hostname=hostname,
-            username=username,
-            password=password,
-            timeout=timeout,
-            optional_args=optional_args,
-        )
-        device.open()
-    except Exception as e:
-        module.fail_json(msg="cannot connect to device: " + str(e))
+    device = run_step(
+        module,
+        "cannot connect to device",
+        open_device,
+        network_driver,
+        hostname=hostname,
+        username=username,
+        password=password,
+        timeout=timeout,
+        optional_args=optional_args,
+    )
 
-    try:
-        if archive_file is not None:
-            running_config = device.get_config(retrieve="running")["running"]
-            save_to_file(running_config, archive_file)
-    except Exception as e:
-        module.fail_json(msg="cannot retrieve running config:" + str(e))
+    with closing_device(module, device):
+        configs = {}
+        # merging can't be short-circuited as the result depends on the running config
+        skip_check = skip_if_equal and replace_config and archive_file is not None
 
-    try:
-        if replace_config and config_file:
-            device.load_replace_candidate(filename=config_file)
-        elif replace_config and config:
-            device.load_replace_candidate(config=config)
-        elif not replace_config and config_file:
-            device.load_merge_candidate(filename=config_file)
-        elif not replace_config and config:
-            device.load_merge_candidate(config=config)
-        else:
-            module.fail_json(msg="You have to specify either config or config_file")
-    except Exception as e:
-        module.fail_json(msg="cannot load config: " + str(e))
+        # the running config doesn't change until commit, so with both files a single
+        # retrieve="all" after the load serves the archive and the candidate
+        retrieve_all = (
+            archive_file is not None and candidate_file is not None and not skip_check
+        )
+
+        finish_archive = None
+        if archive_file is not None and not retrieve_all:
+            finish_archive = archive_running_config(
+                module, device, configs, archive_file
+            )
+        # the candidate is normalized while the running config is being retrieved
+        try:
+            config = normalize_config(config)
+        finally:
+            if finish_archive is not None:
+                finish_archive()
+
+        if skip_check and config_digest(config) == config_digest(configs["running"]):
+            # nothing is loaded, the candidate is the running config and there is no diff
+            if diff_file is not None:
+                run_step(module, "cannot diff config", save_to_file, "", diff_file)
+            if candidate_file is not None:
+                run_step(
+                    module,
+                    "cannot retrieve candidate config",
+                    save_to_file_if_changed,
+                    configs["running"],
+                    candidate_file,
+                )
+            if diff_file is not None and not module._diff:
+                diff_result = summarize_diff("", diff_file)
+            else:
+                diff_result = {"prepared": ""}
+            module.exit_json(changed=False, diff=diff_result, msg="")
+
+        try:
+            load_candidate(device, config, replace_config)
+        except Exception as e:
+            if retrieve_all:
+                # still back up the running config
+                run_step(
+                    module,
+                    "cannot retrieve running config",
+                    save_config,
+                    device,
+                    configs,
+                    "running",
+                    archive_file,
+                )
+            module.fail_json(msg="cannot load config: " + str(e))
+        if retrieve_all:
+            run_step(
+                module,
+                "cannot retrieve running config",
+                save_config,
+                device,
+                configs,
+                "running",
+                archive_file,
+                "all",
+            )
 
-    try:
         if get_diffs:
-            diff = device.compare_config()
-            changed = len(diff) > 0
+            # digests only tell that configs are equal, lines the device adds to the running
+            # config itself make them differ without the candidate changing anything
+            changed, diff = run_step(
+                module,
+                "cannot diff config",
+                compare_configs,
+                device,
+                configs,
+                local_diff,
+                diff_file is not None or module._diff,
+            )
         else:
             changed = True
             diff = None
-        if diff_file is not None and get_diffs:
-            save_to_file(diff, diff_file)
-    except Exception as e:
-        module.fail_json(msg="cannot diff config: " + str(e))
+        if diff_file is not None and diff is not None:
+            run_step(module, "cannot diff config", save_to_file, diff, diff_file)
 
-    try:
         if candidate_file is not None:
-            running_config = device.get_config(retrieve="candidate")["candidate"]
-            save_to_file(running_config, candidate_file)
-    except Exception as e:
-        module.fail_json(msg="cannot retrieve running config:" + str(e))
+            run_step(
+                module,
+                "cannot retrieve candidate config",
+                save_config,
+                device,
+                configs,
+                "candidate",
+                candidate_file,
+            )
 
-    try:
         if module.check_mode or not commit_changes:
-            device.discard_config()
-        else:
-            if changed:
-                device.commit_config(message("commit_comment"))
-    except Exception as e:
-        module.fail_json(msg="cannot install config: " + str(e))
-
-    try:
-        device.close()
-    except Exception as e:
-        module.fail_json(msg="cannot close device connection: " + str(e))
+            run_step(module, "cannot install config", device.discard_config)
+        elif changed and commit_comment:
+            run_step(
+                module,
+                "cannot install config",
+                device.commit_config,
+                message=commit_comment,
+            )
+        elif changed:
+            run_step(module, "cannot install config", device.commit_config)
 
-    module.exit_json(changed=changed, diff={"prepared": diff}, msg=diff)
+    if diff is not None and diff_file is not None and not module._diff:
+        diff_result = summarize_diff(diff, diff_file)
+        diff = truncate_diff(diff, diff_file)
+    else:
+        diff = truncate_diff(diff, diff_file)
+        diff_result = {"prepared": diff}
+    module.exit_json(changed=changed, diff=diff_result, msg=diff)
 
 
 if __name__ == "__main__":
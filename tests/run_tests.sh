@@ -9,7 +9,10 @@ ANSIBLE_REMOTE_USER=vagrant ansible-playbook -i napalm_connection/hosts napalm_c
 
 ansible-playbook -i napalm_install_config/hosts -l "*.dry_run.*" napalm_install_config/config.yaml -C
 ansible-playbook -i napalm_install_config/hosts -l "*.commit.*" napalm_install_config/config.yaml
+ansible-playbook -i napalm_install_config/hosts -l "*.archive.*" napalm_install_config/config_archive.yaml
 ansible-playbook -i napalm_install_config/hosts -l "*.error*" napalm_install_config/config_error.yaml
+ansible-playbook -i napalm_install_config/hosts -l "*.diff.*" napalm_install_config/config_diff.yaml -C
+ansible-playbook -i napalm_install_config/hosts -l "*.local_diff.*" napalm_install_config/config_local_diff.yaml -C
 
 ansible-playbook -i napalm_get_facts/hosts napalm_get_facts/get_facts_ok.yaml -l multiple_facts.ok
 ansible-playbook -i napalm_get_facts/hosts napalm_get_facts/get_facts_not_implemented.yaml -l multiple_facts.not_implemented -e "ignore_notimplemented=true"